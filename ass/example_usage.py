@@ -4,6 +4,9 @@ import json
 # The URL of your API
 API_URL = "http://localhost:8000/api/agents"
 
+# Shared session so consecutive calls reuse one keep-alive connection
+SESSION = requests.Session()
+
 # Example for creating a Vapi.ai agent
 def create_vapi_agent():
     payload = {
@@ -27,7 +30,7 @@ def create_vapi_agent():
         "provider": "vapi"
     }
     
-    response = requests.post(API_URL, json=payload)
+    response = SESSION.post(API_URL, json=payload)
     
     if response.status_code in [200, 201]:
         print("Successfully created Vapi.ai agent:")
@@ -62,7 +65,7 @@ def create_retell_agent():
         }
     }
     
-    response = requests.post(API_URL, json=payload)
+    response = SESSION.post(API_URL, json=payload)
     
     if response.status_code in [200, 201]:
         print("Successfully created Retell agent:")
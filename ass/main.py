@@ -1,30 +1,123 @@
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Body, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import State
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any, List, Union
+from typing import Optional, Dict, Any, List, Union, Tuple, Callable, Awaitable
 import httpx
+import aiohttp
+import asyncio
 import os
+import sys
 from enum import Enum
-import json
+import orjson
+import hashlib
+import logging
+import time
+from functools import partial
+from contextlib import asynccontextmanager
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# How long an identical agent-creation request is answered from the cache
+AGENT_CACHE_TTL_SECONDS = 30
+# How long an expired entry is kept around as a fallback for provider outages
+AGENT_CACHE_STALE_TTL_SECONDS = 24 * 60 * 60
+# Bound every Redis call so an unreachable cache degrades to a miss instead of stalling requests
+AGENT_CACHE_SOCKET_TIMEOUT_SECONDS = 0.5
+
+# Upper bound on agents per /api/agents/multi (or /batch) request, so one call can't fan out without limit
+MAX_AGENTS_PER_REQUEST = 50
+
+# POSTs a pre-encoded JSON body and returns (status code, raw response body)
+PostJSON = Callable[[str, Dict[str, str], bytes], Awaitable[Tuple[int, bytes]]]
+
+async def post_json_httpx(client: httpx.AsyncClient, url: str, headers: Dict[str, str], body: bytes) -> Tuple[int, bytes]:
+    response = await client.post(url, headers=headers, content=body)
+    return response.status_code, response.content
+
+async def post_json_aiohttp(session: aiohttp.ClientSession, url: str, headers: Dict[str, str], body: bytes) -> Tuple[int, bytes]:
+    async with session.post(url, headers=headers, data=body) as response:
+        return response.status, await response.read()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Check the API keys once and share pooled HTTP clients (and an optional Redis cache) across requests"""
+    # Refuse to start without the keys rather than failing every request later
+    for name in ("VAPI_API_KEY", "RETELL_API_KEY"):
+        if not os.environ.get(name):
+            raise RuntimeError(f"{name} not configured in environment")
+    # The keys are fixed for the process lifetime, so the auth headers are built once
+    app.state.vapi_headers = {"Authorization": f"Bearer {os.environ['VAPI_API_KEY']}"}
+    app.state.retell_headers = {"Authorization": f"Bearer {os.environ['RETELL_API_KEY']}"}
+    # HTTP/2 lets concurrent requests to the same provider share one connection
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        headers={"Content-Type": "application/json"},
+        timeout=httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=5.0),
+        # Sized for bursts of agent creation; every dropped keep-alive costs a new TLS handshake
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=int(os.getenv("HTTPX_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=30.0,
+        ),
+    )
+    # aiohttp can outperform httpx under high concurrency; OUTBOUND_HTTP_CLIENT=aiohttp switches to it
+    app.state.aiohttp = None
+    app.state.post_json = partial(post_json_httpx, app.state.http)
+    if os.getenv("OUTBOUND_HTTP_CLIENT") == "aiohttp":
+        app.state.aiohttp = aiohttp.ClientSession(
+            headers={"Content-Type": "application/json"},
+            connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=30),
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+        app.state.post_json = partial(post_json_aiohttp, app.state.aiohttp)
+    # The response cache is opt-in; without REDIS_URL every request goes upstream
+    redis_url = os.getenv("REDIS_URL")
+    app.state.cache = aioredis.from_url(
+        redis_url,
+        socket_timeout=AGENT_CACHE_SOCKET_TIMEOUT_SECONDS,
+        socket_connect_timeout=AGENT_CACHE_SOCKET_TIMEOUT_SECONDS,
+    ) if redis_url else None
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        if app.state.aiohttp is not None:
+            await app.state.aiohttp.close()
+        if app.state.cache is not None:
+            await app.state.cache.aclose()
+
 app = FastAPI(
     title="Unified AI Agent API",
     description="A unified API wrapper for Vapi.ai and Retell Agent services",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+def add_cors_middleware(app: FastAPI):
+    """Enable CORS for browser clients when ENABLE_CORS=1; server-to-server callers skip the middleware entirely"""
+    if os.getenv("ENABLE_CORS") != "1":
+        return
+    
+    origins = [origin.strip() for origin in os.getenv("CORS_ALLOW_ORIGINS", "").split(",") if origin.strip()]
+    if not origins:
+        raise RuntimeError("ENABLE_CORS=1 requires CORS_ALLOW_ORIGINS to list at least one origin")
+    
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+add_cors_middleware(app)
 
 @app.get("/", tags=["Root"])
 async def root():
@@ -36,7 +129,9 @@ async def root():
         "version": "1.0.0",
         "description": "A unified API wrapper for Vapi.ai and Retell Agent services",
         "endpoints": {
-            "create_agent": "/api/agents"
+            "create_agent": "/api/agents",
+            "create_agents_multi": "/api/agents/multi",
+            "create_agents_batch": "/api/agents/batch"
         },
         "documentation": "/docs"
     }
@@ -70,70 +165,40 @@ class AgentConfig(BaseModel):
     provider: AgentProvider = Field(..., description="The provider to use (vapi or retell)")
     provider_specific: Optional[Dict[str, Any]] = None
 
-# API Key validation
-async def validate_api_keys():
-    vapi_key = os.getenv("VAPI_API_KEY")
-    retell_key = os.getenv("RETELL_API_KEY")
-    
-    if not vapi_key:
-        raise HTTPException(status_code=500, detail="VAPI_API_KEY not configured in environment")
-    
-    if not retell_key:
-        raise HTTPException(status_code=500, detail="RETELL_API_KEY not configured in environment")
-    
-    return {"vapi_key": vapi_key, "retell_key": retell_key}
+async def get_cache(request: Request) -> Optional[aioredis.Redis]:
+    return request.app.state.cache
+
+# Voice provider mappings, built once at import time
+_VAPI_VOICE_MAP = {
+    VoiceProvider.ELEVEN_LABS: "eleven_labs",
+    VoiceProvider.DEEPGRAM: "deepgram",
+    VoiceProvider.PLAY_HT: "play_ht",
+    VoiceProvider.OPEN_AI: "open_ai",
+    VoiceProvider.AWS_POLLY: "aws_polly",
+    VoiceProvider.GOOGLE: "google",
+    VoiceProvider.RETELL: "retell"
+}
+
+_RETELL_VOICE_MAP = {
+    VoiceProvider.ELEVEN_LABS: "elevenlabs",
+    VoiceProvider.DEEPGRAM: "deepgram",
+    VoiceProvider.PLAY_HT: "playht",
+    VoiceProvider.OPEN_AI: "openai",
+    VoiceProvider.AWS_POLLY: "polly",
+    VoiceProvider.GOOGLE: "google",
+    VoiceProvider.RETELL: "retell"
+}
 
 def map_voice_provider_to_vapi(provider: VoiceProvider) -> str:
     """Map our standardized voice provider to Vapi's expected format"""
-    mapping = {
-        VoiceProvider.ELEVEN_LABS: "eleven_labs",
-        VoiceProvider.DEEPGRAM: "deepgram",
-        VoiceProvider.PLAY_HT: "play_ht",
-        VoiceProvider.OPEN_AI: "open_ai",
-        VoiceProvider.AWS_POLLY: "aws_polly",
-        VoiceProvider.GOOGLE: "google",
-        VoiceProvider.RETELL: "retell"
-    }
-    return mapping.get(provider, "eleven_labs")  # Default to eleven_labs if not found
+    return _VAPI_VOICE_MAP.get(provider, "eleven_labs")  # Default to eleven_labs if not found
 
 def map_voice_provider_to_retell(provider: VoiceProvider) -> str:
     """Map our standardized voice provider to Retell's expected format"""
-    mapping = {
-        VoiceProvider.ELEVEN_LABS: "elevenlabs",
-        VoiceProvider.DEEPGRAM: "deepgram",
-        VoiceProvider.PLAY_HT: "playht",
-        VoiceProvider.OPEN_AI: "openai",
-        VoiceProvider.AWS_POLLY: "polly",
-        VoiceProvider.GOOGLE: "google",
-        VoiceProvider.RETELL: "retell"
-    }
-    return mapping.get(provider, "elevenlabs")  # Default to elevenlabs if not found
-
-@app.post("/api/agents", status_code=201)
-async def create_agent(
-    config: AgentConfig,
-    api_keys: Dict = Depends(validate_api_keys)
-):
-    """Create an AI agent using either Vapi.ai or Retell"""
-    
-    if config.provider == AgentProvider.VAPI:
-        return await create_vapi_agent(config, api_keys["vapi_key"])
-    elif config.provider == AgentProvider.RETELL:
-        return await create_retell_agent(config, api_keys["retell_key"])
-    else:
-        raise HTTPException(status_code=400, detail="Invalid provider specified")
+    return _RETELL_VOICE_MAP.get(provider, "elevenlabs")  # Default to elevenlabs if not found
 
-async def create_vapi_agent(config: AgentConfig, api_key: str):
-    """Create an agent using Vapi.ai API"""
-    
-    url = "https://api.vapi.ai/assistants"
-    
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    
-    # Map our unified model to Vapi's expected format
+def build_vapi_payload(config: AgentConfig) -> Dict[str, Any]:
+    """Map our unified model to Vapi's expected format"""
     payload = {
         "name": config.name,
         "model": config.llm_model or "gpt-3.5-turbo-0125",  # Default model
@@ -160,42 +225,12 @@ async def create_vapi_agent(config: AgentConfig, api_key: str):
     
     # Add any provider-specific parameters
     if config.provider_specific:
-        for key, value in config.provider_specific.items():
-            payload[key] = value
+        payload.update(config.provider_specific)
     
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, headers=headers, json=payload)
-            response.raise_for_status()
-            result = response.json()
-            
-            # Add provider information to the result
-            result["provider"] = "vapi"
-            
-            return result
-    except httpx.HTTPError as e:
-        if hasattr(e, "response") and e.response:
-            error_detail = e.response.text
-            try:
-                error_json = e.response.json()
-                error_detail = error_json.get("message", error_detail)
-            except:
-                pass
-            raise HTTPException(status_code=e.response.status_code, detail=f"Vapi API error: {error_detail}")
-        else:
-            raise HTTPException(status_code=500, detail=f"Vapi API request failed: {str(e)}")
+    return payload
 
-async def create_retell_agent(config: AgentConfig, api_key: str):
-    """Create an agent using Retell API"""
-    
-    url = "https://api.retellai.com/agents"
-    
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    
-    # Map our unified model to Retell's expected format
+def build_retell_payload(config: AgentConfig) -> Dict[str, Any]:
+    """Map our unified model to Retell's expected format"""
     payload = {
         "name": config.name,
         "llm": {
@@ -225,31 +260,216 @@ async def create_retell_agent(config: AgentConfig, api_key: str):
     
     # Add any provider-specific parameters
     if config.provider_specific:
-        for key, value in config.provider_specific.items():
-            payload[key] = value
+        payload.update(config.provider_specific)
+    
+    return payload
+
+def encode_json(value: Any, option: Optional[int] = None) -> bytes:
+    """Encode request data with orjson, rejecting what it cannot represent (e.g. integers beyond 64 bits) with a 422"""
+    try:
+        return orjson.dumps(value, option=option)
+    except orjson.JSONEncodeError as e:
+        raise HTTPException(status_code=422, detail=f"Agent config cannot be encoded as JSON: {e}")
+
+def agent_cache_key(config: AgentConfig) -> str:
+    """Derive a cache key from the normalized config, which includes the provider"""
+    normalized = encode_json(config.model_dump(mode="json"), option=orjson.OPT_SORT_KEYS)
+    return "agent:" + hashlib.sha256(normalized).hexdigest()
+
+async def read_cached_agent(cache: aioredis.Redis, key: str) -> Optional[Dict[str, Any]]:
+    """Return a cache entry ({"body", "generated_at"}), treating an unreachable cache or a bad entry as a miss"""
+    try:
+        cached = await cache.get(key)
+    except RedisError as e:
+        logger.warning("Agent cache read failed: %s", e)
+        return None
+    if cached is None:
+        return None
+    try:
+        entry = orjson.loads(cached)
+        if isinstance(entry["generated_at"], (int, float)) and "body" in entry:
+            return entry
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        pass
+    logger.warning("Ignoring malformed agent cache entry %s", key)
+    return None
+
+async def store_cached_agent(cache: aioredis.Redis, key: str, result: Dict[str, Any]):
+    """Cache a successful agent response; cache failures never fail the request"""
+    entry = {"body": result, "generated_at": time.time()}
+    try:
+        # Kept for the stale window after it stops being fresh, to serve as an outage fallback
+        await cache.set(key, orjson.dumps(entry), ex=AGENT_CACHE_TTL_SECONDS + AGENT_CACHE_STALE_TTL_SECONDS)
+    except RedisError as e:
+        logger.warning("Agent cache write failed: %s", e)
+
+def is_fresh(entry: Dict[str, Any]) -> bool:
+    return time.time() - entry["generated_at"] < AGENT_CACHE_TTL_SECONDS
+
+@app.post("/api/agents", status_code=201)
+async def create_agent(
+    config: AgentConfig,
+    request: Request,
+    response: Response,
+    allow_stale: bool = Header(False, alias="X-Allow-Stale"),
+    cache: Optional[aioredis.Redis] = Depends(get_cache)
+):
+    """Create an AI agent using either Vapi.ai or Retell"""
+    
+    # Replays of an identical config within the TTL are answered from the cache
+    cached = None
+    if cache is not None:
+        cache_key = agent_cache_key(config)
+        cached = await read_cached_agent(cache, cache_key)
+        if cached is not None and is_fresh(cached):
+            response.headers["X-Cache"] = "HIT"
+            return cached["body"]
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, headers=headers, json=payload)
-            response.raise_for_status()
-            result = response.json()
-            
-            # Add provider information to the result
-            result["provider"] = "retell"
-            
-            return result
-    except httpx.HTTPError as e:
-        if hasattr(e, "response") and e.response:
-            error_detail = e.response.text
-            try:
-                error_json = e.response.json()
-                error_detail = error_json.get("message", error_detail)
-            except:
-                pass
-            raise HTTPException(status_code=e.response.status_code, detail=f"Retell API error: {error_detail}")
+        result = await provision_agent(config, request.app.state)
+    except HTTPException as e:
+        # Fall back to the last known response while the provider is down, if the caller opted in
+        if allow_stale and cached is not None and e.status_code >= 500:
+            response.headers["X-Cache"] = "STALE"
+            return cached["body"]
+        raise
+    
+    if cache is not None:
+        response.headers["X-Cache"] = "MISS"
+        await store_cached_agent(cache, cache_key, result)
+    return result
+
+@app.post("/api/agents/multi")
+async def create_agents_multi(
+    request: Request,
+    configs: List[AgentConfig] = Body(..., max_length=MAX_AGENTS_PER_REQUEST)
+):
+    """Create several agents, e.g. the same agent on both providers, concurrently"""
+    
+    return await provision_agents(configs, request.app.state)
+
+@app.post("/api/agents/batch")
+async def create_agents_batch(
+    request: Request,
+    configs: List[AgentConfig] = Body(..., max_length=MAX_AGENTS_PER_REQUEST)
+):
+    """Bulk-onboarding alias of /api/agents/multi; accepts and returns the same lists"""
+    
+    return await create_agents_multi(request, configs)
+
+async def provision_agents(configs: List[AgentConfig], state: State):
+    """Create every agent concurrently over the shared client, with per-item errors"""
+    
+    results = await asyncio.gather(
+        *(provision_agent(config, state) for config in configs),
+        return_exceptions=True
+    )
+    
+    # Report failures per item so the caller still sees the agents that were created
+    items = []
+    for config, result in zip(configs, results):
+        if isinstance(result, HTTPException):
+            items.append({
+                "provider": config.provider.value,
+                "status_code": result.status_code,
+                "error": result.detail
+            })
+        elif isinstance(result, Exception):
+            logger.error("Agent creation failed for %s", config.provider.value, exc_info=result)
+            items.append({
+                "provider": config.provider.value,
+                "status_code": 500,
+                "error": str(result)
+            })
+        elif isinstance(result, BaseException):
+            raise result
         else:
-            raise HTTPException(status_code=500, detail=f"Retell API request failed: {str(e)}")
+            items.append(result)
+    return items
+
+async def provision_agent(config: AgentConfig, state: State):
+    """Create the agent with the provider selected in its config"""
+    
+    # AgentConfig validation has already rejected unknown providers with a 422
+    create, headers_attr = _AGENT_CREATORS[config.provider]
+    return await create(config, getattr(state, headers_attr), state.post_json)
+
+async def create_vapi_agent(config: AgentConfig, headers: Dict[str, str], post_json: PostJSON):
+    """Create an agent using Vapi.ai API"""
+    
+    url = "https://api.vapi.ai/assistants"
+    
+    # Map our unified model to Vapi's expected format
+    content = encode_json(build_vapi_payload(config))
+    
+    try:
+        status_code, body = await post_json(url, headers, content)
+    except (httpx.HTTPError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise HTTPException(status_code=500, detail=f"Vapi API request failed: {str(e)}")
+    
+    if not 200 <= status_code < 300:
+        error_detail = body.decode(errors="replace")
+        try:
+            error_json = orjson.loads(body)
+            error_detail = error_json.get("message", error_detail)
+        except (orjson.JSONDecodeError, AttributeError):
+            # Not JSON, or JSON that isn't an object; keep the raw text
+            pass
+        raise HTTPException(status_code=status_code, detail=f"Vapi API error: {error_detail}")
+    
+    result = orjson.loads(body)
+    
+    # Add provider information to the result
+    result["provider"] = "vapi"
+    
+    return result
+
+async def create_retell_agent(config: AgentConfig, headers: Dict[str, str], post_json: PostJSON):
+    """Create an agent using Retell API"""
+    
+    url = "https://api.retellai.com/agents"
+    
+    # Map our unified model to Retell's expected format
+    content = encode_json(build_retell_payload(config))
+    
+    try:
+        status_code, body = await post_json(url, headers, content)
+    except (httpx.HTTPError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise HTTPException(status_code=500, detail=f"Retell API request failed: {str(e)}")
+    
+    if not 200 <= status_code < 300:
+        error_detail = body.decode(errors="replace")
+        try:
+            error_json = orjson.loads(body)
+            error_detail = error_json.get("message", error_detail)
+        except (orjson.JSONDecodeError, AttributeError):
+            # Not JSON, or JSON that isn't an object; keep the raw text
+            pass
+        raise HTTPException(status_code=status_code, detail=f"Retell API error: {error_detail}")
+    
+    result = orjson.loads(body)
+    
+    # Add provider information to the result
+    result["provider"] = "retell"
+    
+    return result
+
+# Provider -> (agent creator, app.state attribute holding its auth headers)
+_AGENT_CREATORS = {
+    AgentProvider.VAPI: (create_vapi_agent, "vapi_headers"),
+    AgentProvider.RETELL: (create_retell_agent, "retell_headers"),
+}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # One worker per process only uses one core; default to the 2n+1 rule
+    workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        # uvloop is unavailable on Windows, where the stdlib asyncio loop is used instead
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+    )
\ No newline at end of file
@@ -1,16 +1,24 @@
 import pytest
-from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+import pytest_asyncio
+from unittest.mock import patch, MagicMock, AsyncMock
+import httpx
 import os
 import json
-from main import app
-
-client = TestClient(app)
+from contextlib import asynccontextmanager
+from functools import partial
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from fastapi import FastAPI, HTTPException
+from fastapi.middleware.cors import CORSMiddleware
+from main import app, add_cors_middleware, post_json_httpx, AgentConfig, create_vapi_agent, AGENT_CACHE_TTL_SECONDS, AGENT_CACHE_STALE_TTL_SECONDS, MAX_AGENTS_PER_REQUEST
 
 # Mock environment variables for testing
 os.environ["VAPI_API_KEY"] = "test_vapi_key"
 os.environ["RETELL_API_KEY"] = "test_retell_key"
 
+# Every test shares the session's event loop, app lifespan and client
+pytestmark = pytest.mark.asyncio(loop_scope="session")
+
 # Test data
 test_agent_config = {
     "name": "Test Agent",
@@ -55,33 +63,67 @@ retell_response = {
     "created_at": "2023-01-01T00:00:00Z"
 }
 
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def aclient():
+    # ASGITransport does not run the lifespan, so start it once for the whole session
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            yield client
+
+# Attributes the lifespan sets on app.state
+LIFESPAN_STATE = ("vapi_headers", "retell_headers", "http", "aiohttp", "post_json", "cache")
+
+@asynccontextmanager
+async def restarted_lifespan(env):
+    """Run a fresh lifespan with a patched environment, then restore the session's app state"""
+    session_state = {name: getattr(app.state, name) for name in LIFESPAN_STATE}
+    try:
+        with patch.dict(os.environ, env):
+            async with app.router.lifespan_context(app):
+                yield
+    finally:
+        for name, value in session_state.items():
+            setattr(app.state, name, value)
+
+@pytest.fixture
+def mock_httpx_client(aclient):
+    """Route the shared HTTP client through a mock transport; the mock receives each outbound request"""
+    upstream = MagicMock()
+    mock_client = httpx.AsyncClient(transport=httpx.MockTransport(upstream), headers=app.state.http.headers)
+    post_json = app.state.post_json
+    app.state.post_json = partial(post_json_httpx, mock_client)
+    yield upstream
+    app.state.post_json = post_json
+
 @pytest.fixture
-def mock_httpx_client():
-    with patch("httpx.AsyncClient") as mock_client:
-        async_client = MagicMock()
-        mock_client.return_value.__aenter__.return_value = async_client
-        yield async_client
+def mock_cache(aclient):
+    """Install an in-memory stand-in for the Redis response cache"""
+    store = {}
+    cache = AsyncMock()
+    cache.get.side_effect = store.get
+    cache.set.side_effect = lambda key, value, ex=None: store.__setitem__(key, value)
+    session_cache = app.state.cache
+    app.state.cache = cache
+    yield cache
+    app.state.cache = session_cache
 
-def test_api_health():
+async def test_api_health(aclient):
     """Test that the API is up and running"""
-    response = client.get("/")
-    assert response.status_code == 404  # No root endpoint defined
+    response = await aclient.get("/")
+    assert response.status_code == 200
+    assert response.json()["endpoints"]["create_agent"] == "/api/agents"
 
-@pytest.mark.asyncio
-async def test_create_vapi_agent(mock_httpx_client):
+async def test_create_vapi_agent(aclient, mock_httpx_client):
     """Test creating a Vapi agent"""
     # Configure mock
-    mock_response = MagicMock()
-    mock_response.status_code = 201
-    mock_response.json.return_value = vapi_response
-    mock_httpx_client.post.return_value = mock_response
+    mock_httpx_client.return_value = httpx.Response(201, json=vapi_response)
     
     # Create test data with Vapi provider
     request_data = test_agent_config.copy()
     request_data["provider"] = "vapi"
     
     # Make request
-    response = client.post("/api/agents", json=request_data)
+    response = await aclient.post("/api/agents", json=request_data)
     
     # Assertions
     assert response.status_code == 201
@@ -90,26 +132,23 @@ async def test_create_vapi_agent(mock_httpx_client):
     assert response_data["provider"] == "vapi"
     
     # Check that the correct API was called
-    mock_httpx_client.post.assert_called_once()
-    args, kwargs = mock_httpx_client.post.call_args
-    assert args[0] == "https://api.vapi.ai/assistants"
-    assert kwargs["headers"]["Authorization"] == "Bearer test_vapi_key"
+    mock_httpx_client.assert_called_once()
+    upstream_request = mock_httpx_client.call_args.args[0]
+    assert str(upstream_request.url) == "https://api.vapi.ai/assistants"
+    assert upstream_request.headers["Authorization"] == "Bearer test_vapi_key"
+    assert upstream_request.headers["Content-Type"] == "application/json"
 
-@pytest.mark.asyncio
-async def test_create_retell_agent(mock_httpx_client):
+async def test_create_retell_agent(aclient, mock_httpx_client):
     """Test creating a Retell agent"""
     # Configure mock
-    mock_response = MagicMock()
-    mock_response.status_code = 201
-    mock_response.json.return_value = retell_response
-    mock_httpx_client.post.return_value = mock_response
+    mock_httpx_client.return_value = httpx.Response(201, json=retell_response)
     
     # Create test data with Retell provider
     request_data = test_agent_config.copy()
     request_data["provider"] = "retell"
     
     # Make request
-    response = client.post("/api/agents", json=request_data)
+    response = await aclient.post("/api/agents", json=request_data)
     
     # Assertions
     assert response.status_code == 201
@@ -118,51 +157,329 @@ async def test_create_retell_agent(mock_httpx_client):
     assert response_data["provider"] == "retell"
     
     # Check that the correct API was called
-    mock_httpx_client.post.assert_called_once()
-    args, kwargs = mock_httpx_client.post.call_args
-    assert args[0] == "https://api.retellai.com/agents"
-    assert kwargs["headers"]["Authorization"] == "Bearer test_retell_key"
+    mock_httpx_client.assert_called_once()
+    upstream_request = mock_httpx_client.call_args.args[0]
+    assert str(upstream_request.url) == "https://api.retellai.com/agents"
+    assert upstream_request.headers["Authorization"] == "Bearer test_retell_key"
+
+async def test_retell_payload_mapping(aclient, mock_httpx_client):
+    """Test that the unified config is mapped onto Retell's payload shape"""
+    mock_httpx_client.return_value = httpx.Response(201, json=retell_response)
+    
+    request_data = test_agent_config.copy()
+    request_data["provider"] = "retell"
+    request_data["provider_specific"] = {"end_call_after_silence": 5}
+    
+    response = await aclient.post("/api/agents", json=request_data)
+    
+    assert response.status_code == 201
+    payload = json.loads(mock_httpx_client.call_args.args[0].content)
+    assert payload["name"] == "Test Agent"
+    assert payload["description"] == "A test agent"
+    assert payload["webhook_url"] == "https://example.com/webhook"
+    assert payload["llm"] == {"provider": "openai", "model": "gpt-4"}
+    assert payload["voice"] == {
+        "provider": "elevenlabs",
+        "voice_id": "test-voice-id",
+        "settings": {"stability": 0.5}
+    }
+    assert payload["end_call_after_silence"] == 5
+    assert "provider_specific" not in payload
+
+async def test_empty_optional_fields_omitted(aclient, mock_httpx_client):
+    """Test that empty description and webhook_url are left out of the provider payload"""
+    mock_httpx_client.return_value = httpx.Response(201, json=vapi_response)
+    
+    request_data = test_agent_config.copy()
+    request_data["provider"] = "vapi"
+    request_data["description"] = ""
+    request_data["webhook_url"] = ""
+    
+    response = await aclient.post("/api/agents", json=request_data)
+    
+    assert response.status_code == 201
+    payload = json.loads(mock_httpx_client.call_args.args[0].content)
+    assert "description" not in payload
+    assert "webhook_url" not in payload
 
-@pytest.mark.asyncio
-async def test_invalid_provider():
+async def test_invalid_provider(aclient):
     """Test providing an invalid provider"""
     request_data = test_agent_config.copy()
     request_data["provider"] = "invalid"
     
-    response = client.post("/api/agents", json=request_data)
+    response = await aclient.post("/api/agents", json=request_data)
     
     assert response.status_code == 422  # Validation error
 
-@pytest.mark.asyncio
-async def test_api_key_not_found():
-    """Test behavior when API keys are missing"""
-    with patch.dict(os.environ, {"VAPI_API_KEY": "", "RETELL_API_KEY": ""}):
-        request_data = test_agent_config.copy()
-        request_data["provider"] = "vapi"
+async def test_api_key_not_found(aclient):
+    """Test that the app refuses to start when API keys are missing"""
+    with pytest.raises(RuntimeError, match="VAPI_API_KEY not configured"):
+        async with restarted_lifespan({"VAPI_API_KEY": "", "RETELL_API_KEY": ""}):
+            pass
+    
+    with pytest.raises(RuntimeError, match="RETELL_API_KEY not configured"):
+        async with restarted_lifespan({"RETELL_API_KEY": ""}):
+            pass
+
+async def test_unencodable_config(aclient, mock_httpx_client, mock_cache):
+    """Test that values orjson cannot encode are rejected with a 422 instead of a 500"""
+    request_data = test_agent_config.copy()
+    request_data["metadata"] = {"big": 2 ** 70}
+    
+    for provider in ("vapi", "retell"):
+        request_data["provider"] = provider
         
-        response = client.post("/api/agents", json=request_data)
+        response = await aclient.post("/api/agents", json=request_data)
         
-        assert response.status_code == 500
-        assert "not configured" in response.json()["detail"]
+        assert response.status_code == 422
+        assert "cannot be encoded" in response.json()["detail"]
+    
+    # Without the cache the provider handlers reject it as well
+    app.state.cache = None
+    response = await aclient.post("/api/agents", json=request_data)
+    
+    assert response.status_code == 422
+    mock_httpx_client.assert_not_called()
 
-@pytest.mark.asyncio
-async def test_provider_api_error(mock_httpx_client):
+async def test_provider_api_error(aclient, mock_httpx_client):
     """Test handling of provider API errors"""
     # Configure mock to return an error
-    mock_error_response = MagicMock()
-    mock_error_response.status_code = 400
-    mock_error_response.text = "Bad request"
-    mock_error_response.json.return_value = {"message": "Invalid parameters"}
-    mock_error_response.raise_for_status.side_effect = Exception("HTTP Error")
-    mock_httpx_client.post.return_value = mock_error_response
+    mock_httpx_client.return_value = httpx.Response(400, json={"message": "Invalid parameters"})
     
     # Create test data
     request_data = test_agent_config.copy()
     request_data["provider"] = "vapi"
     
     # Make request
-    response = client.post("/api/agents", json=request_data)
+    response = await aclient.post("/api/agents", json=request_data)
     
     # Assertions
-    assert response.status_code == 500
-    assert "API error" in response.json()["detail"]
\ No newline at end of file
+    assert response.status_code == 400
+    assert "API error" in response.json()["detail"]
+    assert "Invalid parameters" in response.json()["detail"]
+
+async def test_provider_api_error_non_json(aclient, mock_httpx_client):
+    """Test that a non-JSON provider error body is passed through as text"""
+    mock_httpx_client.return_value = httpx.Response(502, text="Bad Gateway")
+    
+    request_data = test_agent_config.copy()
+    request_data["provider"] = "retell"
+    
+    response = await aclient.post("/api/agents", json=request_data)
+    
+    assert response.status_code == 502
+    assert response.json()["detail"] == "Retell API error: Bad Gateway"
+
+async def test_cached_agent_replay(aclient, mock_httpx_client, mock_cache):
+    """Test that replaying an identical config is served from the cache"""
+    mock_httpx_client.return_value = httpx.Response(201, json=vapi_response)
+    
+    request_data = test_agent_config.copy()
+    request_data["provider"] = "vapi"
+    
+    first = await aclient.post("/api/agents", json=request_data)
+    second = await aclient.post("/api/agents", json=request_data)
+    
+    assert first.status_code == 201
+    assert second.status_code == 201
+    assert second.json() == first.json()
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    mock_httpx_client.assert_called_once()
+    
+    # A different provider is a different cache entry
+    mock_httpx_client.return_value = httpx.Response(201, json=retell_response)
+    request_data["provider"] = "retell"
+    
+    third = await aclient.post("/api/agents", json=request_data)
+    
+    assert third.json()["provider"] == "retell"
+    assert mock_httpx_client.call_count == 2
+
+async def test_malformed_cache_entry_is_a_miss(aclient, mock_httpx_client, mock_cache):
+    """Test that corrupt or old-format cache entries fall through to the provider"""
+    mock_httpx_client.return_value = httpx.Response(201, json=vapi_response)
+    
+    request_data = test_agent_config.copy()
+    request_data["provider"] = "vapi"
+    
+    for bad_entry in (b"not json", b'["a list"]', json.dumps(vapi_response).encode()):
+        mock_cache.get.side_effect = lambda key: bad_entry
+        
+        response = await aclient.post("/api/agents", json=request_data)
+        
+        assert response.status_code == 201
+        assert response.headers["X-Cache"] == "MISS"
+    assert mock_httpx_client.call_count == 3
+
+async def test_stale_fallback_on_provider_outage(aclient, mock_httpx_client, mock_cache):
+    """Test that an expired cache entry is served during an outage only when the caller allows it"""
+    mock_httpx_client.return_value = httpx.Response(201, json=vapi_response)
+    
+    request_data = test_agent_config.copy()
+    request_data["provider"] = "vapi"
+    await aclient.post("/api/agents", json=request_data)
+    
+    mock_httpx_client.return_value = httpx.Response(503, text="Service Unavailable")
+    with patch("main.AGENT_CACHE_TTL_SECONDS", 0):
+        response = await aclient.post("/api/agents", json=request_data)
+        assert response.status_code == 503
+        
+        response = await aclient.post("/api/agents", json=request_data, headers={"X-Allow-Stale": "true"})
+        assert response.status_code == 201
+        assert response.headers["X-Cache"] == "STALE"
+        assert response.json()["id"] == "vapi-test-id"
+    
+    # Entries outlive the freshness window by the full stale window
+    assert mock_cache.set.call_args.kwargs["ex"] == AGENT_CACHE_TTL_SECONDS + AGENT_CACHE_STALE_TTL_SECONDS
+
+async def test_create_agents_multi(aclient, mock_httpx_client):
+    """Test creating the same agent on both providers in one request"""
+    def upstream(request):
+        if request.url.host == "api.vapi.ai":
+            return httpx.Response(201, json=vapi_response)
+        return httpx.Response(503, text="Service Unavailable")
+    mock_httpx_client.side_effect = upstream
+    
+    request_data = [
+        {**test_agent_config, "provider": "vapi"},
+        {**test_agent_config, "provider": "retell"}
+    ]
+    
+    response = await aclient.post("/api/agents/multi", json=request_data)
+    
+    assert response.status_code == 200
+    vapi_item, retell_item = response.json()
+    assert vapi_item["id"] == "vapi-test-id"
+    assert vapi_item["provider"] == "vapi"
+    assert retell_item["provider"] == "retell"
+    assert retell_item["status_code"] == 503
+    assert "Retell API error" in retell_item["error"]
+    assert mock_httpx_client.call_count == 2
+
+async def test_create_agents_batch(aclient, mock_httpx_client):
+    """Test bulk creation of several agents"""
+    mock_httpx_client.return_value = httpx.Response(201, json=vapi_response)
+    
+    request_data = [
+        {**test_agent_config, "name": f"Agent {i}", "provider": "vapi"}
+        for i in range(3)
+    ]
+    
+    response = await aclient.post("/api/agents/batch", json=request_data)
+    
+    assert response.status_code == 200
+    assert [item["provider"] for item in response.json()] == ["vapi"] * 3
+    sent_names = sorted(json.loads(call.args[0].content)["name"] for call in mock_httpx_client.call_args_list)
+    assert sent_names == ["Agent 0", "Agent 1", "Agent 2"]
+
+async def test_create_agents_batch_size_limit(aclient, mock_httpx_client):
+    """Test that oversized batches are rejected before anything is sent upstream"""
+    request_data = [{**test_agent_config, "provider": "vapi"}] * (MAX_AGENTS_PER_REQUEST + 1)
+    
+    for path in ("/api/agents/batch", "/api/agents/multi"):
+        response = await aclient.post(path, json=request_data)
+        
+        assert response.status_code == 422
+    mock_httpx_client.assert_not_called()
+
+async def test_create_agents_batch_unexpected_error(aclient, mock_httpx_client):
+    """Test that an unexpected failure on one item does not hide the agents created for the others"""
+    def upstream(request):
+        if json.loads(request.content)["name"] == "Agent 1":
+            return httpx.Response(201, json=["not", "an", "object"])
+        return httpx.Response(201, json=vapi_response)
+    mock_httpx_client.side_effect = upstream
+    
+    request_data = [
+        {**test_agent_config, "name": f"Agent {i}", "provider": "vapi"}
+        for i in range(3)
+    ]
+    
+    response = await aclient.post("/api/agents/batch", json=request_data)
+    
+    assert response.status_code == 200
+    first, failed, last = response.json()
+    assert first["id"] == last["id"] == "vapi-test-id"
+    assert failed["provider"] == "vapi"
+    assert failed["status_code"] == 500
+
+async def test_aiohttp_outbound_client(aclient):
+    """Test that OUTBOUND_HTTP_CLIENT=aiohttp sends provider calls through an aiohttp session"""
+    received = []
+    
+    async def create(request):
+        received.append((request.headers, await request.json()))
+        return web.json_response(vapi_response, status=201)
+    
+    async def reject(request):
+        return web.json_response({"message": "Invalid parameters"}, status=400)
+    
+    stub = web.Application()
+    stub.router.add_post("/create", create)
+    stub.router.add_post("/reject", reject)
+    config = AgentConfig(**test_agent_config, provider="vapi")
+    
+    async with TestServer(stub) as server, restarted_lifespan({"OUTBOUND_HTTP_CLIENT": "aiohttp"}):
+        session = app.state.aiohttp
+        assert app.state.post_json.args == (session,)
+        
+        # Point the Vapi creator at the stub server instead of api.vapi.ai
+        def via(url):
+            return lambda _url, headers, body: app.state.post_json(url, headers, body)
+        
+        result = await create_vapi_agent(config, app.state.vapi_headers, via(str(server.make_url("/create"))))
+        assert result["id"] == "vapi-test-id"
+        assert result["provider"] == "vapi"
+        headers, payload = received[0]
+        assert headers["Authorization"] == "Bearer test_vapi_key"
+        assert headers["Content-Type"] == "application/json"
+        assert payload["name"] == "Test Agent"
+        
+        with pytest.raises(HTTPException) as error:
+            await create_vapi_agent(config, app.state.vapi_headers, via(str(server.make_url("/reject"))))
+        assert error.value.status_code == 400
+        assert error.value.detail == "Vapi API error: Invalid parameters"
+        
+        closed_server_url = str(server.make_url("/create"))
+    assert session.closed
+    
+    # Once the stub is gone the connection is refused (an aiohttp.ClientError), which maps to a 500
+    async with restarted_lifespan({"OUTBOUND_HTTP_CLIENT": "aiohttp"}):
+        with pytest.raises(HTTPException) as error:
+            await create_vapi_agent(config, app.state.vapi_headers, via(closed_server_url))
+    assert error.value.status_code == 500
+    assert "Vapi API request failed" in error.value.detail
+
+async def test_cors_disabled_by_default(aclient):
+    """Test that the CORS middleware is not installed unless ENABLE_CORS=1"""
+    assert all(middleware.cls is not CORSMiddleware for middleware in app.user_middleware)
+    
+    response = await aclient.get("/", headers={"Origin": "https://example.com"})
+    assert "access-control-allow-origin" not in response.headers
+
+async def test_cors_enabled_with_allowed_origins():
+    """Test that ENABLE_CORS=1 parses CORS_ALLOW_ORIGINS and only answers allowed origins"""
+    cors_app = FastAPI()
+    
+    @cors_app.get("/")
+    async def root():
+        return {}
+    
+    env = {"ENABLE_CORS": "1", "CORS_ALLOW_ORIGINS": " https://a.example , https://b.example,"}
+    with patch.dict(os.environ, env):
+        add_cors_middleware(cors_app)
+    
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=cors_app), base_url="http://test") as client:
+        for origin in ("https://a.example", "https://b.example"):
+            response = await client.get("/", headers={"Origin": origin})
+            assert response.headers["access-control-allow-origin"] == origin
+        
+        response = await client.get("/", headers={"Origin": "https://evil.example"})
+        assert "access-control-allow-origin" not in response.headers
+
+async def test_cors_enabled_without_origins():
+    """Test that enabling CORS without any allowed origin fails at startup instead of silently doing nothing"""
+    with patch.dict(os.environ, {"ENABLE_CORS": "1", "CORS_ALLOW_ORIGINS": " , "}):
+        with pytest.raises(RuntimeError, match="CORS_ALLOW_ORIGINS"):
+            add_cors_middleware(FastAPI())
\ No newline at end of file